@@ -1,16 +1,30 @@
 import os
-import time
+import base64
+import hashlib
+import functools
+import gzip
+import io
 import json
 import mimetypes
 import subprocess
 import argparse
 import shutil
+import tempfile
+import queue
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import pystache
 import requests
-from bs4 import BeautifulSoup
-from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import markdown as markdown_package
 from markdown import markdown
 from mdx_gfm import GithubFlavoredMarkdownExtension
 
@@ -113,28 +127,92 @@ OLDER_RELEASES = [
     }
 ]
 
-def compare_version_strings(a, b):
-    a = [int(x) for x in a.split('.')]
-    b = [int(x) for x in b.split('.')]
-
-    for i in range(len(max(a,b))):
-        a_part = a[i] if len(a) > i else 0
-        b_part = b[i] if len(b) > i else 0
-        if a_part != b_part:
-            return (a_part > b_part) - (a_part < b_part)
-    return 0
-
-def get_releases(owner, repo, token):
+# One keep-alive session for every call to GitHub, so that the release listing
+# and tarball downloads don't each pay for a fresh TLS handshake.
+HTTP = requests.Session()
+HTTP.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 502, 503, 504])))
+
+# Lets CloudFront edges hold on to index.html and friends for a while rather
+# than going back to the bucket on every request.
+SITE_CACHE_CONTROL = 'public, max-age=3600'
+
+# Release notes rendered to HTML on previous runs, keyed by GitHub release id.
+# The cache is tagged with the renderer that produced it and discarded when that
+# changes: the Markdown version is picked up automatically, but bump the number
+# when upgrading py-gfm or changing render_body.
+BODY_CACHE_KEY = 'cache/bodies.json'
+_markdown_version = getattr(markdown_package, '__version__', None)
+if not isinstance(_markdown_version, str):
+    # Markdown 2.x exposes its version as markdown.version.
+    _markdown_version = getattr(markdown_package, 'version', 'unknown')
+BODY_CACHE_VERSION = '1/markdown-%s' % _markdown_version
+
+# A release is hosted once there is an empty '.hosted/<name>' key in the bucket.
+# This is the authoritative record: upload_directory writes it (after the
+# release's own '<name>/' marker) only once every file has gone up, and
+# list_uploaded_versions reads nothing else. A '<name>/' prefix on its own may
+# be a partial upload. Releases uploaded before these keys existed only have
+# the '<name>/' marker; upload() backfills their key the first time it meets
+# them, so run with --upload once before relying on an --index-only run.
+HOSTED_PREFIX = '.hosted/'
+
+RENDERER = pystache.Renderer(missing_tags='strict')
+
+GFM_EXTENSION = GithubFlavoredMarkdownExtension()
+
+# Text assets are stored gzipped (with Content-Encoding set) so that they're
+# smaller to upload and CloudFront serves them compressed. Everything else,
+# fonts and images in particular, is already compressed and goes up as is.
+COMPRESSIBLE_MIME_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+}
+
+# Files smaller than this are read (and, if need be, gzipped) in memory and sent
+# with a single put_object. With all the upload workers busy that keeps the
+# peak to a few tens of MiB; anything bigger is streamed from disk.
+IN_MEMORY_LIMIT = 1024 * 1024
+
+# Files above the threshold are sent as a multipart upload with a couple of
+# parts in flight. Each of upload_directory's 32 workers may be running one of
+# these, so 32 x max_concurrency has to fit in the S3 client's connection pool
+# (S3_MAX_POOL_CONNECTIONS).
+UPLOAD_WORKERS = 32
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=2,
+                                 use_threads=True)
+S3_MAX_POOL_CONNECTIONS = UPLOAD_WORKERS * TRANSFER_CONFIG.max_concurrency
+
+def get_releases(owner, repo, token, session):
     url = 'https://api.github.com/repos/%s/%s/releases' % (owner, repo)
 
     headers = {'Authorization': 'token %s' % token}
-    response = requests.get(url, headers=headers)
-    releases = response.json()
 
-    while response.links.get('next'):
-        response = requests.get(response.links.get('next').get('url'),
-                                headers=headers)
-        releases += response.json()
+    def get_page(page):
+        response = session.get(url, headers=headers,
+                               params={'per_page': 100, 'page': page})
+        response.raise_for_status()
+        return response
+
+    # The first page tells us (via the Link header) how many pages there are;
+    # the rest can then be fetched concurrently.
+    first = get_page(1)
+    releases = first.json()
+
+    last = first.links.get('last')
+    if last:
+        query = parse_qs(urlparse(last.get('url')).query)
+        last_page = int(query['page'][0])
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for response in executor.map(get_page, range(2, last_page + 1)):
+                releases += response.json()
 
     return releases
 
@@ -149,127 +227,407 @@ def get_download_link(release, extension='.tar.gz'):
 def get_name(release):
     return release.get('tag_name')[1:]
 
-def is_version_uploaded(bucket, version):
+def has_marker(s3client, bucket, name):
     try:
-        _ = bucket.Object(version + '/').last_modified
+        s3client.head_object(Bucket=bucket.name, Key='%s/' % name)
     except ClientError as e:
         if e.response['Error']['Code'] != '404':
             raise
-        else:
-            return False
+        return False
     return True
 
-def index(releases, bucket, older_releases=None):
+def mark_hosted(s3client, bucket, name):
+    s3client.put_object(Bucket=bucket.name, Key=HOSTED_PREFIX + name, Body=b'')
+
+def list_uploaded_versions(s3client, bucket):
+    # See HOSTED_PREFIX for what counts as hosted.
+    paginator = s3client.get_paginator('list_objects_v2')
+    hosted = set()
+    for page in paginator.paginate(Bucket=bucket.name, Prefix=HOSTED_PREFIX):
+        for obj in page.get('Contents', []):
+            hosted.add(obj['Key'][len(HOSTED_PREFIX):])
+    return hosted
+
+def render_body(body):
+    if not body:
+        return ''
+    return markdown(body, extensions=[GFM_EXTENSION])
+
+@functools.lru_cache(maxsize=None)
+def load_template():
+    # Parsed once and reused across warm Lambda invocations.
     with open('site/index.mustache', 'r') as f:
-        template = f.read()
+        return pystache.parse(f.read())
+
+def load_body_cache(s3client, bucket):
+    try:
+        response = s3client.get_object(Bucket=bucket.name, Key=BODY_CACHE_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return {}
+    cache = json.loads(response['Body'].read().decode('utf-8'))
+    # Anything rendered by a different renderer is thrown away wholesale.
+    if cache.get('version') != BODY_CACHE_VERSION:
+        return {}
+    return cache.get('bodies', {})
+
+def save_body_cache(s3client, bucket, bodies):
+    cache = {'version': BODY_CACHE_VERSION, 'bodies': bodies}
+    s3client.put_object(Bucket=bucket.name, Key=BODY_CACHE_KEY,
+                        Body=json.dumps(cache).encode('utf-8'),
+                        ContentType='application/json')
+
+def render_cached_body(release, cache):
+    # GitHub doesn't tell us when a release's notes were last edited, so the
+    # cache entry is validated against a hash of the markdown instead.
+    body = release.get('body') or ''
+    digest = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    cached = cache.get(str(release.get('id')))
+    if cached and cached.get('sha256') == digest:
+        return cached
+    return {'sha256': digest, 'html': render_body(body)}
+
+def index(releases, bucket, s3client, uploaded_versions, older_releases=None):
+    body_cache = load_body_cache(s3client, bucket)
+    # Rebuilt from just the releases we're listing, so deleted releases drop
+    # out of the cache.
+    new_body_cache = {}
+
+    released = []
+    for release in releases:
+        if get_name(release) not in uploaded_versions:
+            continue
+        entry = render_cached_body(release, body_cache)
+        new_body_cache[str(release.get('id'))] = entry
+        released.append({'name': release.get('name')[1:],
+                         'body': entry['html'],
+                         'date': release.get('created_at')[:10]})
 
-    released = [
-            {'name': release.get('name')[1:],
-             'body': BeautifulSoup(markdown(release.get('body'), extensions=[GithubFlavoredMarkdownExtension()]), 'html.parser').prettify() if release.get('body') else '',
-             'date': release.get('created_at')[:10]}
-            for release in releases
-            if is_version_uploaded(bucket, get_name(release))
-            ]
+    if new_body_cache != body_cache:
+        save_body_cache(s3client, bucket, new_body_cache)
 
     if older_releases is not None:
         released += older_releases
 
-    renderer = pystache.Renderer(missing_tags='strict')
-    rendered = renderer.render(template, {'releases': released})
-
-    bucket.put_object(Key='index.html', Body=rendered,
-            ACL='public-read',
-            ContentType='text/html')
+    rendered = RENDERER.render(load_template(), {'releases': released})
 
-    site_files = [('site/style.css', 'style.css'),
-                  ('site/privacy.html', 'privacy.html')]
-    for source, destination in site_files:
+    site_files = [(rendered.encode('utf-8'), 'index.html', 'text/html')]
+    for source, destination in [('site/style.css', 'style.css'),
+                                ('site/privacy.html', 'privacy.html')]:
         with open(source, 'rb') as data:
             mime_type = mimetypes.guess_type(source)[0]
             if not mime_type:
                 mime_type = 'application/octet-stream'
-            bucket.put_object(Key=destination,
-                              Body=data,
-                              ACL='public-read',
-                              ContentType=mime_type)
-
-def upload_directory(name, root, bucket):
-    for subdir, dirs, files in os.walk(root):
-        for file in files:
-            full_path = os.path.join(subdir, file)
-            destination_path = name + full_path[len(root):]
-            with open(full_path, 'rb') as data:
-                mime_type = mimetypes.guess_type(full_path)[0]
-                if not mime_type:
-                    mime_type = 'application/octet-stream'
-                print('Putting %s (%s)' % (destination_path, mime_type))
-                bucket.put_object(Key=destination_path,
-                                  Body=data,
-                                  ACL='public-read',
-                                  ContentType=mime_type)
-    # If we don't do this, we can't easily test whether the 'directory' exists in S3
-    bucket.put_object(Key='%s/' % name, Body='')
-
-
-def upload(releases, bucket, older_releases):
+            site_files.append((data.read(), destination, mime_type))
+
+    def put_one(site_file):
+        body, destination, mime_type = site_file
+        s3client.put_object(Bucket=bucket.name,
+                            Key=destination,
+                            Body=body,
+                            ACL='public-read',
+                            ContentType=mime_type,
+                            CacheControl=SITE_CACHE_CONTROL)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(put_one, site_files))
+
+    return rendered
+
+def list_etags(s3client, bucket, prefix):
+    paginator = s3client.get_paginator('list_objects_v2')
+    return {obj['Key']: obj['ETag'].strip('"')
+            for page in paginator.paginate(Bucket=bucket.name, Prefix=prefix)
+            for obj in page.get('Contents', [])}
+
+def gzip_into(source, destination):
+    # mtime is pinned so that the same input always gives the same bytes (and
+    # so the same ETag).
+    with gzip.GzipFile(fileobj=destination, mode='wb', compresslevel=6,
+                       mtime=0) as gz:
+        shutil.copyfileobj(source, gz, length=1 << 20)
+
+def is_compressible(mime_type):
+    return mime_type.startswith('text/') or mime_type in COMPRESSIBLE_MIME_TYPES
+
+def walk_files(root):
+    # os.scandir hands back DirEntry objects that already know whether they're
+    # a directory, which saves os.walk's extra stat per entry.
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path)
+            elif entry.is_symlink() and entry.is_dir():
+                # Like os.walk without followlinks: links to directories are
+                # neither descended into nor uploaded.
+                continue
+            else:
+                yield entry
+
+def upload_directory(name, root, bucket, s3client):
+    tasks = []
+    mime_types = {}
+    root_len = len(root)
+    for entry in walk_files(root):
+        full_path = entry.path
+        destination_path = name + full_path[root_len:]
+        ext = os.path.splitext(entry.name)[1]
+        mime_type = mime_types.get(ext)
+        if mime_type is None:
+            mime_type = mimetypes.guess_type('x' + ext)[0]
+            if not mime_type:
+                mime_type = 'application/octet-stream'
+            mime_types[ext] = mime_type
+        tasks.append((full_path, destination_path, mime_type,
+                      entry.stat().st_size))
+
+    # Anything left over from an earlier, interrupted attempt at this release
+    # needn't be sent again if it hasn't changed.
+    existing = list_etags(s3client, bucket, '%s/' % name)
+
+    def put_one(task):
+        full_path, destination_path, mime_type, size = task
+        compress = is_compressible(mime_type)
+        extra_args = {'ACL': 'public-read', 'ContentType': mime_type}
+        if compress:
+            extra_args['ContentEncoding'] = 'gzip'
+
+        if size >= IN_MEMORY_LIMIT:
+            # Bigger files are streamed from disk, and big text assets (the JS
+            # bundles) gzipped via a temporary file, so they're never held in
+            # memory. We don't hash these to compare ETags: above the multipart
+            # threshold the ETag isn't an md5 of the content anyway.
+            print('Putting %s (%s)' % (destination_path, mime_type))
+            with open(full_path, 'rb') as data, tempfile.TemporaryFile() as compressed:
+                body = data
+                if compress:
+                    gzip_into(data, compressed)
+                    compressed.seek(0)
+                    body = compressed
+                s3client.upload_fileobj(body, bucket.name, destination_path,
+                                        ExtraArgs=extra_args,
+                                        Config=TRANSFER_CONFIG)
+            return
+
+        # Small files go up as a plain PUT. They're read once, for the md5 we
+        # compare against, and that digest and the length are handed to
+        # botocore so it doesn't work either out again.
+        with open(full_path, 'rb') as data:
+            if compress:
+                compressed = io.BytesIO()
+                gzip_into(data, compressed)
+                body = compressed.getvalue()
+            else:
+                body = data.read()
+        md5 = hashlib.md5(body)
+        if existing.get(destination_path) == md5.hexdigest():
+            print('Skipping %s (unchanged)' % destination_path)
+            return
+        print('Putting %s (%s)' % (destination_path, mime_type))
+        s3client.put_object(Bucket=bucket.name,
+                            Key=destination_path,
+                            Body=body,
+                            ContentLength=len(body),
+                            ContentMD5=base64.b64encode(md5.digest()).decode('ascii'),
+                            **extra_args)
+
+    # Each PUT is a round trip of its own, and a release is thousands of small
+    # files, so keep plenty of them in flight at once.
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        list(executor.map(put_one, tasks))
+
+    # Only reached once every file has gone up (executor.map re-raises any
+    # failed PUT); see HOSTED_PREFIX.
+    s3client.put_object(Bucket=bucket.name, Key='%s/' % name, Body=b'')
+    mark_hosted(s3client, bucket, name)
+
+
+def download_and_explode(session, url, destination):
+    # Pipe the tarball straight into tar rather than writing it to disk first,
+    # so that extraction overlaps with the download.
+    tar = subprocess.Popen(['tar', '-xzf', '-', '-C', destination],
+                           stdin=subprocess.PIPE)
+    try:
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            shutil.copyfileobj(response.raw, tar.stdin, length=1 << 20)
+    finally:
+        # If tar has already died, flushing its stdin fails too; don't let that
+        # hide the original error or skip reaping the process.
+        try:
+            tar.stdin.close()
+        except BrokenPipeError:
+            pass
+        tar.wait()
+    if tar.returncode != 0:
+        raise subprocess.CalledProcessError(tar.returncode, tar.args)
+
+
+def remove_exploded(name):
+    shutil.rmtree('/tmp/exploded/%s' % name, ignore_errors=True)
+
+
+def fetch_release(release, session):
+    name = get_name(release)
+    print('%s: not hosted in bucket; fetching...' % name)
+    download_url = get_download_link(release)
+    os.makedirs('/tmp/exploded/%s' % name, exist_ok=True)
+    download_and_explode(session, download_url, '/tmp/exploded/%s/' % name)
+    print('%s: tarball downloaded and exploded' % name)
+    tar_root = '/tmp/exploded/%s/%s' % (name, os.listdir('/tmp/exploded/%s/' % name)[0])
+
+    if name != '0.9.0':
+        print('%s: copying default config...' % name)
+        shutil.copyfile(tar_root + '/config.sample.json', tar_root + '/config.json')
+    else:
+        print('%s: patching in a config file for 0.9.0, released without config...' % name)
+        shutil.copyfile('config.0.9.0.json', tar_root + '/config.json')
+
+    return tar_root
+
+
+def upload(releases, bucket, uploaded_versions, older_releases, session,
+           s3client):
+    newly_uploaded = []
+
+    def is_hosted(name):
+        if name in uploaded_versions:
+            return True
+        # Uploaded before completion keys existed; backfill its key.
+        if has_marker(s3client, bucket, name):
+            mark_hosted(s3client, bucket, name)
+            uploaded_versions.add(name)
+            return True
+        return False
+
     for release in older_releases:
         name = release.get('name')
-        if is_version_uploaded(bucket, name):
+        if is_hosted(name):
             print('%s: (older release) already hosted in bucket' % name)
-        else:
-            print('%s: (older release) uploading' % name)
-            upload_directory(name, 'older_riots/%s' % name, bucket)
-            print('%s: (older release) uploaded' % name)
-
+            continue
+
+        root = 'older_riots/%s' % name
+        if not os.path.isdir(root):
+            # older_riots/ isn't packaged into the Lambda, and walk_files (unlike
+            # os.walk) would raise on a missing root; skip rather than abort the run.
+            print('%s: (older release) not hosted and no local copy at %s; skipping' % (name, root))
+            continue
+
+        print('%s: (older release) uploading' % name)
+        upload_directory(name, root, bucket, s3client)
+        uploaded_versions.add(name)
+        newly_uploaded.append(name)
+        print('%s: (older release) uploaded' % name)
+
+    pending = []
     for release in releases:
         name = get_name(release)
         if name == '0.7.3':
             # We can't process any releases from 0.7.3 and older :( (yet)
             break
-        if is_version_uploaded(bucket, name):
+        if is_hosted(name):
             print('%s: already hosted in bucket' % name)
-        else:
-            print('%s: not hosted in bucket; fetching...' % name)
-            download_url = get_download_link(release)
-            response = requests.get(download_url)
-            os.makedirs('/tmp/downloads/%s' % name, exist_ok=True)
-            if response.status_code == 200:
-                filename = '/tmp/downloads/%s/%s.tar.gz' % (name, name)
-                with open(filename, 'wb') as download:
-                    for chunk in response.iter_content(chunk_size=128):
-                        download.write(chunk)
-            print('%s: tarball downloaded; exploding...' % name)
-            os.makedirs('/tmp/exploded/%s' % name, exist_ok=True)
-            subprocess.call(['tar', '-zxf', filename, '-C', '/tmp/exploded/%s/' % name])
-            tar_root = '/tmp/exploded/%s/%s' % (name, os.listdir('/tmp/exploded/%s/' % name)[0])
-
-            if name != '0.9.0':
-                print('%s: tarball exploded; copying default config...' % name)
-                shutil.copyfile(tar_root + '/config.sample.json', tar_root + '/config.json')
-            else:
-                print('%s: tarball exploded; patching in a config file for 0.9.0, released without config...' % name)
-                shutil.copyfile('config.0.9.0.json', tar_root + '/config.json')
-
-            print('%s: config inserted; uploading to s3...' % name)
+            continue
+        pending.append(release)
+
+    # Fetch the next release in the background while the current one is being
+    # uploaded. With room for only one waiting release, no more than three are
+    # ever exploded in /tmp at once: one uploading, one queued, one fetching.
+    fetched = queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def offer(item):
+        # Like fetched.put, but gives up if the uploader has stopped listening.
+        while not stop.is_set():
+            try:
+                fetched.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_all():
+        for release in pending:
+            name = get_name(release)
+            try:
+                tar_root = fetch_release(release, session)
+            except Exception as e:
+                remove_exploded(name)
+                offer(e)
+                return
+            if not offer((name, tar_root)):
+                remove_exploded(name)
+                return
+        offer(None)
+
+    fetcher = threading.Thread(target=fetch_all, daemon=True)
+    fetcher.start()
 
-            upload_directory(name, tar_root, bucket)
+    try:
+        while True:
+            item = fetched.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            name, tar_root = item
+            try:
+                print('%s: config inserted; uploading to s3...' % name)
+                upload_directory(name, tar_root, bucket, s3client)
+            finally:
+                remove_exploded(name)
+            uploaded_versions.add(name)
+            newly_uploaded.append(name)
             print('%s upload complete; now available at https://riots.im/%s' % (name, name))
+    finally:
+        # If we're bailing out early, the fetcher may be blocked handing over
+        # its next release. Tell it to stop, wait for it, then clear away
+        # anything it fetched that we never got to.
+        stop.set()
+        fetcher.join()
+        while True:
+            try:
+                item = fetched.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                remove_exploded(item[0])
+
+    return newly_uploaded
+
+
+def invalidate_cloudfront_cache(cloudfrontClient, distributionId,
+                                rendered_index, newly_uploaded):
+    # If we neither rewrote the index nor uploaded anything, nothing served
+    # can have changed, so there's deliberately nothing to invalidate.
+    if not rendered_index and not newly_uploaded:
+        return None
 
+    # Invalidate everything in one go if we've pushed new releases; otherwise
+    # only the index can have changed.
+    if newly_uploaded:
+        paths = ['/*']
+    else:
+        paths = ['/', '/index.html']
 
-def invalidate_cloudfront_cache(cloudfrontClient, distributionId):
-    paths = ['/', '/index.html']
+    # CloudFront treats a reused CallerReference as the same invalidation for
+    # good, so this must be unique per run rather than derived from content
+    # (which can legitimately repeat). botocore's own retries resend the same
+    # parameters, so a retried request still isn't duplicated.
     batch = {
         'Paths': {
             'Quantity': len(paths),
             'Items': paths
         },
-        'CallerReference': str(time.time())
+        'CallerReference': uuid.uuid4().hex
     }
     invalidation = cloudfrontClient.create_invalidation(
         DistributionId=distributionId,
         InvalidationBatch=batch,
     )
-    return batch
+    return invalidation
 
 def do_the_needful(aws_access_key_id, aws_secret_access_key, aws_bucket,
         aws_cloudfront_distribution_id, github_token, run_index, run_upload):
@@ -278,19 +636,48 @@ def do_the_needful(aws_access_key_id, aws_secret_access_key, aws_bucket,
         aws_access_key_id=aws_access_key_id,
         aws_secret_access_key=aws_secret_access_key
     )
-    s3client = session.client('s3')
+    # Sized for upload_directory's workers and their multipart transfers.
+    s3client = session.client(
+        's3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
     s3resource = session.resource('s3')
     cloudfrontClient = session.client('cloudfront')
 
-    releases = get_releases('vector-im', 'riot-web', token=github_token)
+    releases = get_releases('vector-im', 'riot-web', token=github_token,
+                            session=HTTP)
     bucket = s3resource.Bucket(aws_bucket)
+    uploaded_versions = list_uploaded_versions(s3client, bucket)
 
-    if run_index:
-        index(releases, bucket, OLDER_RELEASES)
+    rendered_index = ''
+    newly_uploaded = []
+    # Upload first: it adds what it uploads (or backfills) to uploaded_versions,
+    # so the index then lists everything that's actually hosted.
     if run_upload:
-        upload(releases, bucket, OLDER_RELEASES)
+        newly_uploaded = upload(releases, bucket, uploaded_versions,
+                                OLDER_RELEASES, HTTP, s3client)
+    if run_index:
+        rendered_index = index(releases, bucket, s3client, uploaded_versions,
+                               OLDER_RELEASES)
 
-    invalidate_cloudfront_cache(cloudfrontClient, aws_cloudfront_distribution_id)
+    invalidate_cloudfront_cache(cloudfrontClient,
+                                aws_cloudfront_distribution_id,
+                                rendered_index, newly_uploaded)
+
+
+def lambda_handler(who, cares):
+    do_the_needful(
+        aws_access_key_id=os.environ['aws_access_key_id'],
+        aws_secret_access_key=os.environ['aws_secret_access_key'],
+        aws_bucket=os.environ['aws_bucket'],
+        aws_cloudfront_distribution_id=os.environ['aws_cloudfront_distribution_id'],
+        github_token=os.environ['github_token'],
+        run_index=True,
+        run_upload=True
+    )
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Hello from Lambda!')
+    }
 
 
 if __name__ == '__main__':
@@ -313,20 +700,3 @@ if __name__ == '__main__':
         run_index=args.index,
         run_upload=args.upload,
     )
-
-def lambda_handler(who, cares):
-    do_the_needful(
-        aws_access_key_id=os.environ['aws_access_key_id'],
-        aws_secret_access_key=os.environ['aws_secret_access_key'],
-        aws_bucket=os.environ['aws_bucket'],
-        aws_cloudfront_distribution_id=os.environ['aws_cloudfront_distribution_id'],
-        github_token=os.environ['github_token'],
-        run_index=True,
-        run_upload=True
-    )
-
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Hello from Lambda!')
-    }
-